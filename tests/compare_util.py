@@ -4,6 +4,10 @@ import os
 import re
 import struct
 import numpy as np
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 use_cosine_to_double_check = True
 
@@ -67,6 +71,18 @@ class SegmentTolerance:
                 self.verbose_type == VerboseType.PRINT_BAD and current_state == DiffState.BAD:
             print(print_prefix + "{}".format(diff))
 
+    def add_diffs(self, total, count, max_diff, print_prefix=""):
+        self.accumulated_diff += total
+        self.n_diff += count
+
+        current_state = DiffState.GOOD if max_diff <= self.diff_thresh else DiffState.BAD
+        if current_state == DiffState.BAD:
+            self.diff_state = current_state
+
+        if self.verbose_type == VerboseType.PRINT_EVERY or \
+                self.verbose_type == VerboseType.PRINT_BAD and current_state == DiffState.BAD:
+            print(print_prefix + "{}".format(max_diff))
+
     def __str__(self):
         return "[{}, {}) thr={} type={} -> {} / {} = {}, {}".format(
             self.seg_min,
@@ -137,6 +153,101 @@ class Index(object):
         return shape_index
 
 
+# returns (max_abs, max_rel, sum_abs, sum_rel). the relative diff is divided
+# by the signed ground truth, as Judge.judge does. any NaN diff makes every result NaN
+def _compare_arrays(a, b):
+    max_abs = 0.0
+    max_rel = -np.inf
+    sum_abs = 0.0
+    sum_rel = 0.0
+    for i in range(a.size):
+        diff = abs(a[i] - b[i])
+        if np.isnan(diff):
+            return np.nan, np.nan, np.nan, np.nan
+        rel = diff / a[i] if a[i] != 0 else 0.0
+        max_abs = max(max_abs, diff)
+        max_rel = max(max_rel, rel)
+        sum_abs += diff
+        sum_rel += rel
+    return max_abs, max_rel, sum_abs, sum_rel
+
+
+def _compare_arrays_np(a, b):
+    if a.size == 0:
+        return 0.0, -np.inf, 0.0, 0.0
+    diff = np.abs(a - b)
+    if np.isnan(diff).any():
+        return np.nan, np.nan, np.nan, np.nan
+    rel = np.divide(diff, a, out=np.zeros_like(diff), where=a != 0)
+    return float(diff.max()), float(rel.max()), float(diff.sum()), float(rel.sum())
+
+
+compare_arrays_njit = njit(cache=True)(_compare_arrays) if njit is not None else _compare_arrays_np
+
+
+def default_judge(verbose, cfg=None):
+    first_threshold = 0.6 if hasattr(
+        cfg, 'op') and cfg.op == 'tf.reduce_prod' else 0.5
+    first_threshold = 1.0 if hasattr(
+        cfg, 'op') and cfg.op == 'random_connections' else first_threshold
+
+    return Judge([
+        SegmentTolerance(0, 64, first_threshold, DiffType.ABS, verbose),
+        SegmentTolerance(64, 128, 2, DiffType.ABS, verbose),
+        SegmentTolerance(128, 10 ** 18, 8 / 128, DiffType.REL, verbose),
+        SegmentTolerance(10 ** 18, float('inf'), 44 / 128, DiffType.REL, verbose)])
+
+
+def compare_arrays(
+        ground_truth,
+        result,
+        verbose=VerboseType.PRINT_EVERY,
+        judge=None,
+        cfg=None):
+
+    if judge is None:
+        judge = default_judge(verbose, cfg)
+
+    all_gt = np.asarray(ground_truth, dtype=np.float64).reshape(-1)
+    pred = np.asarray(result, dtype=np.float64).reshape(-1)
+
+    if all_gt.size == pred.size:
+        gt = all_gt
+    elif all_gt.size == 9 * pred.size:
+        candidates = all_gt.reshape(9, -1)
+        nearest = np.abs(candidates - pred).argmin(axis=0)
+        gt = candidates[nearest, np.arange(pred.size)]
+    else:
+        print('# of elements in gt and result not match\n')
+        raise ValueError
+
+    # same accounting as judging every element, per segment
+    magnitude = np.abs(gt)
+    n_judged = 0
+    for tol in judge.tolerances:
+        mask = (tol.seg_min <= magnitude) & (magnitude < tol.seg_max)
+        count = int(np.count_nonzero(mask))
+        n_judged += count
+        if count == 0:
+            continue
+        max_abs, max_rel, sum_abs, sum_rel = compare_arrays_njit(gt[mask], pred[mask])
+        if tol.diff_type == DiffType.REL:
+            max_diff, total = max_rel, sum_rel
+        else:
+            max_diff, total = max_abs, sum_abs
+        tol.add_diffs(total, count, max_diff, '[max] ')
+    judge.n_outlier += gt.size - n_judged
+
+    print(judge)
+    if judge.is_good() == False:
+        # like compare(), pair the result with the leading ground truth lines
+        all_gt = all_gt[:pred.size]
+        judge.cosine_similarity = float(
+            np.dot(all_gt, pred) / (np.linalg.norm(all_gt) * np.linalg.norm(pred)))
+        print("cosine_similarity is: {}".format(judge.cosine_similarity))
+    return judge
+
+
 def compare(
         ground_truth_path,
         result_path,
@@ -144,17 +255,8 @@ def compare(
         judge=None,
         cfg=None):
 
-    first_threshold = 0.6 if hasattr(
-        cfg, 'op') and cfg.op == 'tf.reduce_prod' else 0.5
-    first_threshold = 1.0 if hasattr(
-        cfg, 'op') and cfg.op == 'random_connections' else first_threshold
-
     if judge is None:
-        judge = Judge([
-            SegmentTolerance(0, 64, first_threshold, DiffType.ABS, verbose),
-            SegmentTolerance(64, 128, 2, DiffType.ABS, verbose),
-            SegmentTolerance(128, 10 ** 18, 8 / 128, DiffType.REL, verbose),
-            SegmentTolerance(10 ** 18, float('inf'), 44 / 128, DiffType.REL, verbose)])
+        judge = default_judge(verbose, cfg)
 
     gt_num_lines = sum(1 for line in open(ground_truth_path)) - 1
     res_num_lines = sum(1 for line in open(result_path)) - 1
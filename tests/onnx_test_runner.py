@@ -62,7 +62,7 @@ class OnnxTestRunner(TestRunner):
         try:
             shape_dict = {}
             for input in self.inputs:
-                input_dict[input['name']] = input['shape']
+                input_dict[input.name] = input.shape
 
             if fix_bn:
                 # fix https://github.com/onnx/models/issues/242
@@ -104,13 +104,13 @@ class OnnxTestRunner(TestRunner):
         # input
         for _, e in enumerate(input_tensors):
             onnx_type = e.type.tensor_type
-            input_dict = {}
-            input_dict['name'] = e.name
-            input_dict['dtype'] = onnx.mapping.TENSOR_TYPE_TO_NP_TYPE[onnx_type.elem_type]
-            input_dict['shape'] = [(i.dim_value if i.dim_value != 0 else d) for i, d in zip(
-                onnx_type.shape.dim, [1, 3, 224, 224])]
-            self.inputs.append(input_dict)
-            self.calibs.append(input_dict.copy())
+            input_spec = TensorSpec(
+                name=e.name,
+                shape=tuple((i.dim_value if i.dim_value != 0 else d) for i, d in zip(
+                    onnx_type.shape.dim, [1, 3, 224, 224])),
+                dtype=onnx.mapping.TENSOR_TYPE_TO_NP_TYPE[onnx_type.elem_type])
+            self.inputs.append(input_spec)
+            self.calibs.append(input_spec)
 
         # output
 
@@ -136,16 +136,17 @@ class OnnxTestRunner(TestRunner):
 
         input_dict = {}
         for input in self.inputs:
-            input_dict[input['name']] = input['data']
+            input_dict[input.name] = input.data
 
         outputs = sess.run(None, input_dict)
         i = 0
         for output in outputs:
             bin_file = os.path.join(case_dir, f'cpu_result_{i}.bin')
             text_file = os.path.join(case_dir, f'cpu_result_{i}.txt')
-            self.output_paths.append((bin_file, text_file))
-            output.tofile(bin_file)
-            save_array_as_txt(text_file, output)
+            self.output_paths.append((bin_file, text_file, output.dtype, output.shape))
+            save_array_as_bin(bin_file, output, self.cfg.setup.compress_dumps)
+            if self.cfg.setup.dump_txt:
+                save_array_as_txt(text_file, output)
             i += 1
 
     def import_model(self, compiler, model_content, import_options):
@@ -0,0 +1,72 @@
+# Copyright 2019-2021 Canaan Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# pylint: disable=invalid-name, unused-argument, import-outside-toplevel
+
+import pytest
+import numpy as np
+from compare_util import compare, compare_arrays, DiffState, VerboseType
+
+
+def _save_txt(path, data):
+    with open(path, 'w') as f:
+        f.write("shape: (" + ",".join(str(dim) for dim in data.shape) + ")\n")
+        for val in data.reshape([-1]):
+            f.write("%f\n" % val)
+
+
+def _make_case(name):
+    # multiples of 1/64 round-trip exactly through the "%f" text dumps
+    rng = np.random.default_rng(0)
+    gt = rng.integers(-300 * 64, 300 * 64, size=(4, 64)) / 64
+    pred = gt + rng.integers(-16, 16, size=gt.shape) / 64
+    if name == 'fail_abs':
+        gt[0, 0] = 10
+        pred[0, 0] = 13
+    elif name == 'negative_rel':
+        gt[1, 0] = -200
+        pred[1, 0] = 100
+    elif name == 'nan':
+        pred[2, 3] = np.nan
+    elif name == 'nine_times':
+        gt = np.concatenate([gt + k for k in range(-4, 5)])
+    return gt, pred
+
+
+cases = ['pass', 'fail_abs', 'negative_rel', 'nan', 'nine_times']
+
+
+@pytest.mark.parametrize('name', cases)
+def test_compare_arrays_matches_compare(name, tmp_path):
+    gt, pred = _make_case(name)
+    gt_file = str(tmp_path / 'gt.txt')
+    pred_file = str(tmp_path / 'pred.txt')
+    _save_txt(gt_file, gt)
+    _save_txt(pred_file, pred)
+
+    expected = compare(gt_file, pred_file, VerboseType.SILENT)
+    actual = compare_arrays(gt, pred, VerboseType.SILENT)
+
+    assert actual.is_good() == expected.is_good()
+    assert actual.n_outlier == expected.n_outlier
+    for a, e in zip(actual.tolerances, expected.tolerances):
+        assert a.diff_state == e.diff_state
+        assert a.n_diff == e.n_diff
+        assert np.isclose(a.accumulated_diff, e.accumulated_diff, equal_nan=True)
+    assert np.isclose(actual.cosine_similarity, expected.cosine_similarity, equal_nan=True)
+    if name in ('fail_abs', 'nan'):
+        assert any(tol.diff_state == DiffState.BAD for tol in actual.tolerances)
+
+
+if __name__ == "__main__":
+    pytest.main(['-vv', 'test_compare_util.py'])
@@ -0,0 +1,105 @@
+# Copyright 2019-2021 Canaan Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# pylint: disable=invalid-name, unused-argument, import-outside-toplevel
+
+import struct
+import pytest
+import numpy as np
+
+pytest.importorskip('nncase')
+import test_runner  # noqa: E402
+from test_runner import (_cast_bfloat16_then_float32, Edict, load_array_from_bin,  # noqa: E402
+                         save_array_as_bin, TensorSpec, TestRunner)
+
+
+def _stub_runner():
+    # generate_data only reads the setup config from the runner
+    class Stub:
+        cfg = Edict({'setup': {'dump_txt': False, 'compress_dumps': False}})
+    return Stub()
+
+
+def _gen_cfg(batch_size, numbers=1):
+    return Edict({'name': 'generate_random', 'numbers': numbers, 'batch_size': batch_size})
+
+
+def _cast_bfloat16_then_float32_ref(values):
+    # the original per element implementation
+    shape = values.shape
+    values = values.reshape([-1])
+    for i, value in enumerate(values):
+        value = float(value)
+        packed = struct.pack('!f', value)
+        packed = packed[:2] + b'\x00\x00'
+        values[i] = struct.unpack('!f', packed)[0]
+    return values.reshape(shape)
+
+
+def test_cast_bfloat16_then_float32():
+    rng = np.random.default_rng(0)
+    values = (rng.standard_normal((3, 5, 7)) * 1000).astype(np.float32)
+    values[0, 0, :4] = [0, -0.0, np.inf, -np.inf]
+    expected = _cast_bfloat16_then_float32_ref(values.copy())
+    actual = _cast_bfloat16_then_float32(values)
+    assert actual.shape == values.shape
+    assert actual.dtype == np.float32
+    assert np.array_equal(actual.view(np.uint32), expected.view(np.uint32))
+
+
+def test_generate_data_fills_tensor_spec(tmp_path):
+    spec = TensorSpec(name='x', shape=[1, 3, 4], dtype=np.float32, index=0)
+    inputs, paths = [spec], []
+    TestRunner.generate_data(_stub_runner(), _gen_cfg(1), str(tmp_path), inputs, paths, 'input')
+    assert spec.data is None
+    assert inputs[0].name == 'x' and inputs[0].index == 0
+    assert inputs[0].shape == [1, 3, 4] and inputs[0].dtype is np.float32
+    assert inputs[0].data.shape == (1, 3, 4)
+    assert np.array_equal(np.fromfile(paths[0][0], dtype=np.float32).reshape(1, 3, 4),
+                          inputs[0].data)
+
+
+def test_generate_data_twice_keeps_shapes(tmp_path):
+    # the runners append the same spec to inputs and calibs, and run_single
+    # regenerates data for every case on the same lists
+    spec = TensorSpec(name='x', shape=[1, 3, 4], dtype=np.float32, index=0)
+    inputs, calibs = [spec], [spec]
+    runner = _stub_runner()
+    for _ in range(2):
+        input_paths, calib_paths = [], []
+        TestRunner.generate_data(runner, _gen_cfg(1), str(tmp_path),
+                                 inputs, input_paths, 'input')
+        TestRunner.generate_data(runner, _gen_cfg(10, 2), str(tmp_path),
+                                 calibs, calib_paths, 'calib')
+        assert inputs[0].shape == [1, 3, 4] and calibs[0].shape == [1, 3, 4]
+        assert inputs[0].data.shape == (1, 3, 4)
+        assert calibs[0].data.shape == (10, 3, 4)
+        assert len(input_paths) == 1 and len(calib_paths) == 2
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.uint8, np.int8])
+@pytest.mark.parametrize('compress', [False, True])
+def test_bin_round_trip(dtype, compress, tmp_path):
+    if compress and test_runner.bloscpack is None:
+        pytest.skip('bloscpack is not usable')
+    data = np.arange(2 * 3 * 5).astype(dtype).reshape(2, 3, 5)
+    path = str(tmp_path / 'data.bin')
+    # non contiguous input is written in logical order
+    save_array_as_bin(path, data.transpose(1, 0, 2), compress)
+    loaded = load_array_from_bin(path, dtype, (3, 2, 5), compress)
+    assert loaded.dtype == dtype
+    assert np.array_equal(loaded, data.transpose(1, 0, 2))
+
+
+if __name__ == "__main__":
+    pytest.main(['-vv', 'test_test_runner.py'])
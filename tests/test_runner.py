@@ -1,15 +1,33 @@
-from typing import Dict, List, Tuple
-from itertools import product
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from itertools import groupby, product
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import functools
+import multiprocessing
 import re
 import yaml
 from pathlib import Path
 import numpy as np
 import os
 import shutil
+import tempfile
+import threading
 from abc import ABCMeta, abstractmethod
 import nncase
-import struct
-from compare_util import compare_with_ground_truth, VerboseType
+from compare_util import compare_arrays, VerboseType
+try:
+    import bloscpack
+except (ImportError, AttributeError):
+    # bloscpack 0.16 still uses collections.MutableMapping, gone since python 3.10
+    bloscpack = None
+
+
+class TensorSpec(NamedTuple):
+    name: str
+    shape: tuple
+    dtype: np.dtype
+    data: Optional[np.ndarray] = None
+    index: Optional[int] = None
 
 
 class Edict:
@@ -48,43 +66,110 @@ class Edict:
         return s.rstrip('\n')
 
 
+_RNG = np.random.default_rng()
+_NUM_RE = re.compile(r'(\d+)')
+
+
 def generate_random(shape: List[int], dtype: np.dtype) -> np.ndarray:
+    shape = tuple(shape)
     if dtype is np.uint8:
-        data = np.random.randint(0, 256, shape)
+        data = _RNG.integers(0, 256, size=shape, dtype=np.uint8)
     elif dtype is np.int8:
-        data = np.random.randint(-128, 128, shape)
+        data = _RNG.integers(-128, 128, size=shape, dtype=np.int8)
     else:
-        data = np.random.rand(*shape) * 2 - 1
-    data = data.astype(dtype=dtype)
+        data = _RNG.random(size=shape, dtype=np.float32) * 2 - 1
+        data = data.astype(dtype=dtype, copy=False)
     return data
 
 
-def save_array_as_txt(save_path, value_np, bit_16_represent=False):
-    if bit_16_represent:
-        np.save(save_path, _cast_bfloat16_then_float32(value_np))
+def save_array_as_bin(save_path, value_np, compress=False):
+    if compress:
+        bloscpack.pack_ndarray_to_file(np.ascontiguousarray(value_np), save_path + '.blp',
+                                       blosc_args=bloscpack.BloscArgs(cname='lz4', shuffle=True))
     else:
-        with open(save_path, 'w') as f:
-            shape_info = "shape: (" + ",".join(str(dim)
-                                               for dim in value_np.shape) + ")\n"
-            f.write(shape_info)
+        with open(save_path, 'wb', buffering=1 << 20) as f:
+            f.write(np.ascontiguousarray(value_np).data)
+
+
+def load_array_from_bin(load_path, dtype, shape, compress=False) -> np.ndarray:
+    if compress:
+        return bloscpack.unpack_ndarray_from_file(load_path + '.blp')
+    return np.fromfile(load_path, dtype=dtype).reshape(shape)
 
-            for val in value_np.reshape([-1]):
-                f.write("%f\n" % val)
+
+def save_array_as_txt(save_path, value_np, bit_16_represent=False):
+    if bit_16_represent:
+        value_np = _cast_bfloat16_then_float32(value_np)
+    with open(save_path, 'w', buffering=1 << 20) as f:
+        shape_info = "shape: (" + ",".join(str(dim)
+                                           for dim in value_np.shape) + ")\n"
+        f.write(shape_info)
+        np.savetxt(f, value_np.reshape([-1]), fmt='%f')
     print("----> %s" % save_path)
 
 
 def _cast_bfloat16_then_float32(values: np.array):
-    shape = values.shape
-    values = values.reshape([-1])
-    for i, value in enumerate(values):
-        value = float(value)
-        packed = struct.pack('!f', value)
-        integers = [c for c in packed][:2] + [0, 0]
-        value = struct.unpack('!f', bytes(integers))[0]
-        values[i] = value
-
-    values = values.reshape(shape)
-    return values
+    data = np.ascontiguousarray(values, dtype=np.float32)
+    data = data.view(np.uint32) & np.uint32(0xFFFF0000)
+    return data.view(np.float32).reshape(values.shape)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_cfg(cfg_path: str, mtime: float) -> Dict:
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(cfg_path, encoding='utf8') as f:
+        return yaml.load(f, Loader=loader)
+
+
+_FORK_STATE = None
+_REMOVE_THREADS: List[threading.Thread] = []
+
+
+def _is_single_threaded() -> bool:
+    # counts native threads too (TF/ORT thread pools), unlike threading.active_count()
+    try:
+        return len(os.listdir('/proc/self/task')) == 1
+    except OSError:
+        return False
+
+
+def _call_in_fork(group):
+    fn, fixed_args = _FORK_STATE
+    return [fn(*fixed_args, kwargs) for kwargs in group]
+
+
+def map_combos(fn, fixed_args: tuple, combos: List[Dict], workers: int) -> List:
+    # combos must be sorted by target, each target group runs in one worker
+    # so that per-target compilers are reused inside the group.
+    # nncase holds the GIL, so run in forked processes which inherit fn/fixed_args.
+    # forking a process with other live threads (e.g. TF/ORT thread pools) may deadlock
+    # the children, so fall back to running serially unless this is the only thread
+    global _FORK_STATE
+    groups = [list(group) for _, group in groupby(combos, key=lambda c: c['target'])]
+    workers = min(workers, len(groups))
+    if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return [fn(*fixed_args, kwargs) for kwargs in combos]
+    while _REMOVE_THREADS:
+        _REMOVE_THREADS.pop().join()
+    if not _is_single_threaded():
+        return [fn(*fixed_args, kwargs) for kwargs in combos]
+    _FORK_STATE = (fn, fixed_args)
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            return [result for results in executor.map(_call_in_fork, groups) for result in results]
+    finally:
+        _FORK_STATE = None
+
+
+def remove_dir_async(path: str):
+    # move the tree out of the way, then delete it while the test proceeds
+    path = os.path.abspath(path)
+    trash = tempfile.mkdtemp(prefix='.trash_', dir=os.path.dirname(path))
+    os.rename(path, os.path.join(trash, os.path.basename(path)))
+    thread = threading.Thread(target=shutil.rmtree, args=(trash,),
+                              kwargs={'ignore_errors': True})
+    thread.start()
+    _REMOVE_THREADS.append(thread)
 
 
 Fuc = {
@@ -95,9 +180,9 @@ Fuc = {
 class TestRunner(metaclass=ABCMeta):
     def __init__(self, case_name, targets=None) -> None:
         config_root = os.path.dirname(__file__)
-        with open(os.path.join(config_root, 'config.yml'), encoding='utf8') as f:
-            cfg = yaml.safe_load(f)
-            config = Edict(cfg)
+        cfg_path = os.path.join(config_root, 'config.yml')
+        cfg = copy.deepcopy(_load_cfg(cfg_path, os.path.getmtime(cfg_path)))
+        config = Edict(cfg)
 
         self.cfg = self.validte_config(config)
 
@@ -115,15 +200,21 @@ class TestRunner(metaclass=ABCMeta):
             self.cfg.case.eval[0].values = targets
             self.cfg.case.infer[0].values = targets
 
-        self.inputs: List[Dict] = []
-        self.calibs: List[Dict] = []
-        self.outputs: List[Dict] = []
+        self.inputs: List[TensorSpec] = []
+        self.calibs: List[TensorSpec] = []
+        self.outputs: List[TensorSpec] = []
         self.input_paths: List[Tuple[str, str]] = []
         self.calib_paths: List[Tuple[str, str]] = []
-        self.output_paths: List[Tuple[str, str]] = []
-        self.num_pattern = re.compile("(\d+)")
+        self.output_paths: List[Tuple[str, str, np.dtype, tuple]] = []
+        self._eval_target = None
+        self._eval_compiler = None
+        self._evaluator = None
+        self.result_file = None
 
     def validte_config(self, config):
+        if config.setup.compress_dumps and bloscpack is None:
+            print("WARN: bloscpack not found, dumps will not be compressed")
+            config.setup.compress_dumps = False
         return config
 
     def validate_targets(self, targets):
@@ -154,7 +245,7 @@ class TestRunner(metaclass=ABCMeta):
         in_ci = os.getenv('CI', False)
         if in_ci:
             if os.path.exists(self.cfg.setup.root):
-                shutil.rmtree(self.cfg.setup.root)
+                remove_dir_async(self.cfg.setup.root)
         else:
             if os.path.exists(case_dir):
                 shutil.rmtree(case_dir)
@@ -173,17 +264,22 @@ class TestRunner(metaclass=ABCMeta):
         pass
 
     def run_single(self, cfg, case_dir: str, model_file: str):
-        if not self.inputs:
-            self.parse_model_input_output(model_file)
-        self.generate_data(cfg.generate_inputs, case_dir,
-                           self.inputs, self.input_paths, 'input')
-        self.generate_data(cfg.generate_calibs, case_dir,
-                           self.calibs, self.calib_paths, 'calib')
-        self.cpu_infer(case_dir, model_file)
-        import_options, compile_options = self.get_compiler_options(cfg, model_file)
-        model_content = self.read_model_file(model_file)
-        self.run_evaluator(cfg, case_dir, import_options, compile_options, model_content)
-        self.run_inference(cfg, case_dir, import_options, compile_options, model_content)
+        self.result_file = open(os.path.join(self.case_dir, 'test_result.txt'),
+                                'a', buffering=1 << 16)
+        try:
+            if not self.inputs:
+                self.parse_model_input_output(model_file)
+            self.generate_data(cfg.generate_inputs, case_dir,
+                               self.inputs, self.input_paths, 'input')
+            self.generate_data(cfg.generate_calibs, case_dir,
+                               self.calibs, self.calib_paths, 'calib')
+            self.cpu_infer(case_dir, model_file)
+            import_options, compile_options = self.get_compiler_options(cfg, model_file)
+            model_content = self.read_model_file(model_file)
+            self.run_evaluator(cfg, case_dir, import_options, compile_options, model_content)
+            self.run_inference(cfg, case_dir, import_options, compile_options, model_content)
+        finally:
+            self.on_test_end()
 
     def get_compiler_options(self, cfg, model_file):
         import_options = nncase.ImportOptions(**cfg.importer_opt.kwargs)
@@ -196,31 +292,42 @@ class TestRunner(metaclass=ABCMeta):
 
         compile_options = nncase.CompileOptions()
         for k, v in cfg.compile_opt.kwargs.items():
-            e = '"'
-            exec(
-                f'compile_options.{k} = {e + v + e if isinstance(v, str) else v}')
+            setattr(compile_options, k, v)
         return import_options, compile_options
 
+    def get_workers(self) -> int:
+        if not getattr(self.cfg.setup, 'parallel', False):
+            return 1
+        return min(self.cfg.setup.numworkers, os.cpu_count() or 1)
+
     def run_evaluator(self, cfg, case_dir, import_options, compile_options, model_content):
         names, args = TestRunner.split_value(cfg.eval)
-        for combine_args in product(*args):
-            dict_args = dict(zip(names, combine_args))
-            eval_output_paths = self.generate_evaluates(
-                cfg, case_dir, import_options,
-                compile_options, model_content, dict_args)
+        combos = [dict(zip(names, combine_args)) for combine_args in product(*args)]
+        combos.sort(key=lambda c: c['target'])
+        results = map_combos(self.generate_evaluates,
+                             (cfg, case_dir, import_options, compile_options, model_content),
+                             combos, self.get_workers())
+        self._eval_target = None
+        self._eval_compiler = None
+        self._evaluator = None
+        for dict_args, eval_output_paths in zip(combos, results):
             assert self.compare_results(
                 self.output_paths, eval_output_paths, dict_args)
 
     def run_inference(self, cfg, case_dir, import_options, compile_options, model_content):
         names, args = TestRunner.split_value(cfg.infer)
+        combos = []
         for combine_args in product(*args):
             dict_args = dict(zip(names, combine_args))
             if dict_args['ptq'] and len(self.inputs) > 1:
                 continue
+            combos.append(dict_args)
+        combos.sort(key=lambda c: c['target'])
 
-            infer_output_paths = self.nncase_infer(
-                cfg, case_dir, import_options,
-                compile_options, model_content, dict_args)
+        results = map_combos(self.nncase_infer,
+                             (cfg, case_dir, import_options, compile_options, model_content),
+                             combos, self.get_workers())
+        for dict_args, infer_output_paths in zip(combos, results):
             assert self.compare_results(
                 self.output_paths, infer_output_paths, dict_args)
 
@@ -251,18 +358,26 @@ class TestRunner(metaclass=ABCMeta):
                            import_options: nncase.ImportOptions,
                            compile_options: nncase.CompileOptions,
                            model_content: bytes, kwargs: Dict[str, str]
-                           ) -> List[Tuple[str, str]]:
+                           ) -> List[Tuple[str, str, np.dtype, tuple]]:
         eval_dir = TestRunner.kwargs_to_path(
             os.path.join(case_dir, 'eval'), kwargs)
-        compile_options.target = kwargs['target']
-        compile_options.dump_dir = eval_dir
-        compiler = nncase.Compiler(compile_options)
-        self.import_model(compiler, model_content, import_options)
-        evaluator = compiler.create_evaluator(3)
+        os.makedirs(eval_dir, exist_ok=True)
+        # the evaluator only depends on the target, reuse it until the target changes.
+        # ir/asm dumps are written at import time, so each combination needs its own compiler then
+        dumps = compile_options.dump_ir or compile_options.dump_asm
+        if dumps or self._evaluator is None or self._eval_target != kwargs['target']:
+            compile_options.target = kwargs['target']
+            compile_options.dump_dir = eval_dir
+            compiler = nncase.Compiler(compile_options)
+            self.import_model(compiler, model_content, import_options)
+            self._eval_target = kwargs['target']
+            self._eval_compiler = compiler
+            self._evaluator = compiler.create_evaluator(3)
+        evaluator = self._evaluator
         eval_output_paths = []
         for i in range(len(self.inputs)):
             input_tensor = nncase.RuntimeTensor.from_numpy(
-                self.inputs[i]['data'])
+                self.inputs[i].data)
             input_tensor.copy_to(evaluator.get_input_tensor(i))
             evaluator.run()
 
@@ -270,16 +385,19 @@ class TestRunner(metaclass=ABCMeta):
             result = evaluator.get_output_tensor(i).to_numpy()
             eval_output_paths.append((
                 os.path.join(eval_dir, f'nncase_result_{i}.bin'),
-                os.path.join(eval_dir, f'nncase_result_{i}.txt')))
-            result.tofile(eval_output_paths[-1][0])
-            save_array_as_txt(eval_output_paths[-1][1], result)
+                os.path.join(eval_dir, f'nncase_result_{i}.txt'),
+                result.dtype, result.shape))
+            save_array_as_bin(eval_output_paths[-1][0], result,
+                              self.cfg.setup.compress_dumps)
+            if self.cfg.setup.dump_txt:
+                save_array_as_txt(eval_output_paths[-1][1], result)
         return eval_output_paths
 
     def nncase_infer(self, cfg, case_dir: str,
                      import_options: nncase.ImportOptions,
                      compile_options: nncase.CompileOptions,
                      model_content: bytes, kwargs: Dict[str, str]
-                     ) -> List[Tuple[str, str]]:
+                     ) -> List[Tuple[str, str, np.dtype, tuple]]:
         infer_dir = TestRunner.kwargs_to_path(
             os.path.join(case_dir, 'infer'), kwargs)
         compile_options.target = kwargs['target']
@@ -288,7 +406,8 @@ class TestRunner(metaclass=ABCMeta):
         self.import_model(compiler, model_content, import_options)
         if kwargs['ptq']:
             ptq_options = nncase.PTQTensorOptions()
-            ptq_options.set_tensor_data(np.asarray([sample['data'] for sample in self.calibs]).tobytes())
+            ptq_options.set_tensor_data(
+                b''.join(np.ascontiguousarray(sample.data).data for sample in self.calibs))
             ptq_options.samples_count = cfg.generate_calibs.batch_size
             ptq_options.input_mean = cfg.ptq_opt.kwargs['input_mean']
             ptq_options.input_std = cfg.ptq_opt.kwargs['input_std']
@@ -303,7 +422,7 @@ class TestRunner(metaclass=ABCMeta):
         infer_output_paths: List[np.ndarray] = []
         for i in range(len(self.inputs)):
             sim.set_input_tensor(
-                i, nncase.RuntimeTensor.from_numpy(self.inputs[i]['data']))
+                i, nncase.RuntimeTensor.from_numpy(self.inputs[i].data))
 
         sim.run()
 
@@ -311,29 +430,30 @@ class TestRunner(metaclass=ABCMeta):
             result = sim.get_output_tensor(i).to_numpy()
             infer_output_paths.append((
                 os.path.join(infer_dir, f'nncase_result_{i}.bin'),
-                os.path.join(infer_dir, f'nncase_result_{i}.txt')))
-            result.tofile(infer_output_paths[-1][0])
-            save_array_as_txt(infer_output_paths[-1][1], result)
+                os.path.join(infer_dir, f'nncase_result_{i}.txt'),
+                result.dtype, result.shape))
+            save_array_as_bin(infer_output_paths[-1][0], result,
+                              self.cfg.setup.compress_dumps)
+            if self.cfg.setup.dump_txt:
+                save_array_as_txt(infer_output_paths[-1][1], result)
         return infer_output_paths
 
     def on_test_start(self) -> None:
         pass
 
-    def generate_data(self, cfg, case_dir: str, inputs: List[Dict], path_list: List[str], name: str):
+    def generate_data(self, cfg, case_dir: str, inputs: List[TensorSpec], path_list: List[str], name: str):
+        shapes = [(input.shape[0] * cfg.batch_size, *input.shape[1:]) for input in inputs]
         for n in range(cfg.numbers):
-            i = 0
-            for input in inputs:
-                shape = input['shape']
-                shape[0] *= cfg.batch_size
-                data = Fuc[cfg.name](shape, input['dtype'])
+            for i, input in enumerate(inputs):
+                data = Fuc[cfg.name](shapes[i], input.dtype)
 
                 path_list.append(
                     (os.path.join(case_dir, f'{name}_{n}_{i}.bin'),
                      os.path.join(case_dir, f'{name}_{n}_{i}.txt')))
-                data.tofile(path_list[-1][0])
-                save_array_as_txt(path_list[-1][1], data)
-                i += 1
-                input['data'] = data
+                save_array_as_bin(path_list[-1][0], data, self.cfg.setup.compress_dumps)
+                if self.cfg.setup.dump_txt:
+                    save_array_as_txt(path_list[-1][1], data)
+                inputs[i] = input._replace(data=data)
 
     def process_input(self, inputs: List[np.array], **kwargs) -> None:
         pass
@@ -342,29 +462,32 @@ class TestRunner(metaclass=ABCMeta):
         pass
 
     def on_test_end(self) -> None:
-        pass
+        if self.result_file is not None:
+            self.result_file.close()
+            self.result_file = None
 
     def compare_results(self,
                         ref_ouputs: List[Tuple[str]],
                         test_outputs: List[Tuple[str]],
                         kwargs: Dict[str, str]):
         for ref_file, test_file in zip(ref_ouputs, test_outputs):
-            judge = compare_with_ground_truth(test_file[1],
-                                              ref_file[1],
-                                              state=0,
-                                              verbose=VerboseType.PRINT_RESULT)
-            name_list = test_file[1].split('/')
+            ref = load_array_from_bin(ref_file[0], ref_file[2], ref_file[3],
+                                      self.cfg.setup.compress_dumps)
+            test = load_array_from_bin(test_file[0], test_file[2], test_file[3],
+                                       self.cfg.setup.compress_dumps)
+            judge = compare_arrays(ref, test, verbose=VerboseType.PRINT_RESULT)
+            name_list = Path(test_file[1]).parts
             kw_names = ' '.join(name_list[-len(kwargs) - 2:-1])
-            i = self.num_pattern.findall(name_list[-1])
+            i = _NUM_RE.findall(name_list[-1])
             if judge.is_good():
                 result = "\nPass [ {0} ] Output: {1}!!\n".format(kw_names, i)
                 print(result)
-                with open(os.path.join(self.case_dir, 'test_result.txt'), 'a+') as f:
-                    f.write(result)
+                self.result_file.write(result)
             else:
+                save_array_as_txt(ref_file[1], ref)
+                save_array_as_txt(test_file[1], test)
                 result = "\nFail [ {0} ] Output: {1}!!\n".format(kw_names, i)
                 print(result)
-                with open(os.path.join(self.case_dir, 'test_result.txt'), 'a+') as f:
-                    f.write(result)
+                self.result_file.write(result)
                 return False
         return True
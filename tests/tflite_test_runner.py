@@ -32,40 +32,36 @@ class TfliteTestRunner(TestRunner):
         interp = tf.lite.Interpreter(model_path=model_path)
 
         for item in interp.get_input_details():
-            input_dict = {}
-            input_dict['index'] = item['index']
-            input_dict['name'] = item['name']
-            input_dict['dtype'] = item['dtype']
-            input_dict['shape'] = item['shape']
-            self.inputs.append(input_dict)
-            self.calibs.append(input_dict.copy())
+            input_spec = TensorSpec(name=item['name'], shape=tuple(item['shape']),
+                                    dtype=item['dtype'], index=item['index'])
+            self.inputs.append(input_spec)
+            self.calibs.append(input_spec)
 
         for item in interp.get_output_details():
-            output_dict = {}
-            output_dict['index'] = item['index']
-            output_dict['name'] = item['name']
-            output_dict['dtype'] = item['dtype']
-            output_dict['shape'] = item['shape']
-            self.outputs.append(output_dict)
+            output_spec = TensorSpec(name=item['name'], shape=tuple(item['shape']),
+                                     dtype=item['dtype'], index=item['index'])
+            self.outputs.append(output_spec)
 
     def cpu_infer(self, case_dir: str, model_file: bytes):
         interp = tf.lite.Interpreter(model_path=model_file)
         interp.allocate_tensors()
         for input in self.inputs:
-            interp.set_tensor(input["index"], input['data'])
+            interp.set_tensor(input.index, input.data)
 
         interp.invoke()
 
         i = 0
         for output in self.outputs:
-            data = interp.get_tensor(output['index'])
+            data = interp.get_tensor(output.index)
             self.output_paths.append((
                 os.path.join(case_dir, f'cpu_result_{i}.bin'),
-                os.path.join(case_dir, f'cpu_result_{i}.txt')))
-            data.tofile(self.output_paths[-1][0])
-            save_array_as_txt(self.output_paths[-1][1], data)
+                os.path.join(case_dir, f'cpu_result_{i}.txt'),
+                data.dtype, data.shape))
+            save_array_as_bin(self.output_paths[-1][0], data,
+                              self.cfg.setup.compress_dumps)
+            if self.cfg.setup.dump_txt:
+                save_array_as_txt(self.output_paths[-1][1], data)
             i += 1
-            # output['data'] = data
 
     def import_model(self, compiler, model_content, import_options):
         compiler.import_tflite(model_content, import_options)
\ No newline at end of file